@@ -1,51 +1,193 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import pptx.oxml
 from pptx import Presentation
 from pptx.util import Pt
 from pptx.enum.shapes import MSO_SHAPE_TYPE
+from pptx.oxml.ns import qn
+from pptx.opc.constants import RELATIONSHIP_TYPE as RT
+from pptx.parts.image import Image, ImagePart
+from pptx.opc.serialized import PackageWriter, _ZipPkgWriter
 from pptx.enum.dml import MSO_FILL_TYPE
 from pptx.dml.color import RGBColor
+from pptx.text.text import Font
+from lxml import etree
 import io
+import zipfile
 import copy
 import uuid
-import openai
 import json
 import requests
 import os
-import subprocess
-import tempfile
-import shutil
-import mimetypes
-import httpx # <-- ADD THIS IMPORT
+import hashlib
+import math
+from collections import Counter, OrderedDict
+import re
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+# --- Hardened XML Parser for python-pptx ---
+# python-pptx already disables entity resolution and strips blank text; additionally forbid network
+# access and drop comments/processing instructions so uploaded decks parse into smaller trees
+_oxml_parser = etree.XMLParser(
+    remove_blank_text=True,
+    resolve_entities=False,
+    no_network=True,
+    huge_tree=False,
+    remove_comments=True,
+    remove_pis=True,
+)
+_oxml_parser.set_element_class_lookup(pptx.oxml.element_class_lookup)
+pptx.oxml.oxml_parser = _oxml_parser
 
 # --- Configuration for the Conversion Service ---
 CONVERSION_SERVICE_URL = os.getenv("CONVERSION_SERVICE_URL", "http://localhost:8000/convert_document")
 
+# --- Precompiled XPath Queries ---
+_NS = {
+    'p': 'http://schemas.openxmlformats.org/presentationml/2006/main',
+    'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
+}
+# Top-level shapes with a paragraph containing "lorem ipsum" (case-insensitive), found in one pass per slide.
+# Shapes nested in groups are never visited by populate_slide, so the query does not descend into them.
+LOREM_XPATH = etree.XPath(
+    "./p:cSld/p:spTree/p:sp[p:txBody/a:p[contains(translate(string(.), 'LOREMIPSU', 'loremipsu'), 'lorem ipsum')]]",
+    namespaces=_NS,
+)
+# Placeholder (<p:ph>) elements of the top-level shapes on a slide
+_PLACEHOLDERS = etree.XPath('./p:cSld/p:spTree/p:sp/p:nvSpPr/p:nvPr/p:ph', namespaces=_NS)
+
+_A_P = '{http://schemas.openxmlformats.org/drawingml/2006/main}p'
+_A_T = '{http://schemas.openxmlformats.org/drawingml/2006/main}t'
+_A_BR = '{http://schemas.openxmlformats.org/drawingml/2006/main}br'
+_A_R = '{http://schemas.openxmlformats.org/drawingml/2006/main}r'
+_A_FLD = '{http://schemas.openxmlformats.org/drawingml/2006/main}fld'
+
+def element_text(shape_elm):
+    # Same result as shape.text, but gathered with lxml's C-level iter() instead of building
+    # python-pptx TextFrame/Paragraph/Run wrappers for every paragraph and run
+    return "\n".join(
+        "".join("\v" if el.tag == _A_BR else (el.text or "") for el in p.iter(_A_T, _A_BR))
+        for p in shape_elm.iter(_A_P)
+    )
+
+# --- Layout Heuristics (EMU, computed once instead of per shape) ---
+_TITLE_TOP_LIMIT = Pt(150)
+_MIN_BODY_HEIGHT = Pt(100)
+# Placeholder types (ST_PlaceholderType values as python-pptx parses them) that take the title and the body
+_TITLE_PH_TYPES = frozenset((1, 2, 8))
+_BODY_PH_TYPES = frozenset((3, 4, 8, 14))
+
+# --- Image Part Reuse ---
+_image_parts_by_package = weakref.WeakKeyDictionary()
+
+_copied_image_parts = weakref.WeakKeyDictionary()
+
+def package_image_part(package, image_bytes: bytes):
+    # python-pptx looks for an existing copy of an image by walking every relationship in the package and
+    # rehashing every image blob, once per added picture. Hash each package's images once and index them instead.
+    image_parts = _image_parts_by_package.get(package)
+    if image_parts is None:
+        image_parts = _image_parts_by_package[package] = {
+            part.sha1: part for part in package._image_parts if hasattr(part, "sha1")
+        }
+    sha1 = hashlib.sha1(image_bytes).hexdigest()
+    image_part = image_parts.get(sha1)
+    if image_part is None:
+        image_part = image_parts[sha1] = ImagePart.new(package, Image.from_blob(image_bytes))
+    return image_part
+
+def get_or_add_copied_image_part(slide, src_image_part):
+    # Template decks share the same logo/background image across many slides. Remember which destination part
+    # each source part became, so a shared image is hashed once per output deck rather than once per copied slide.
+    package = slide.part.package
+    copies = _copied_image_parts.get(package)
+    if copies is None:
+        copies = _copied_image_parts[package] = {}
+    image_part = copies.get(src_image_part)
+    if image_part is None:
+        image_part = copies[src_image_part] = package_image_part(package, src_image_part.blob)
+    return image_part, slide.part.relate_to(image_part, RT.IMAGE)
+
+def add_picture(slide, src_image_part, left, top, width, height):
+    image_part, rId = get_or_add_copied_image_part(slide, src_image_part)
+    shapes = slide.shapes
+    shapes._add_pic_from_image_part(image_part, rId, left, top, width, height)
+    shapes._recalculate_extents()
+
+# --- Relationship Remapping for Copied XML ---
+_R_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_HYPERLINK_TAGS = frozenset((qn('a:hlinkClick'), qn('a:hlinkHover')))
+
+def can_relate_in_destination(rel):
+    # Image blobs can be copied and external targets reused; any other part (a chart, an OLE object, SmartArt
+    # data, another slide of the source deck) belongs to the source package and cannot be carried over
+    return rel is not None and (rel.is_external or rel.reltype == RT.IMAGE)
+
+def relate_in_destination(rel, dest_slide):
+    if rel.is_external:
+        return dest_slide.part.relate_to(rel.target_ref, rel.reltype, is_external=True)
+    return get_or_add_copied_image_part(dest_slide, rel.target_part)[1]
+
+def relate_copied_element(new_el, src_part, dest_slide) -> bool:
+    # XML copied from another slide still points at the source slide's relationships. Re-create them on the
+    # destination (image blobs are copied, external targets reused) and rewrite the references; each attribute
+    # is read and rewritten exactly once, so new rIds never chain.
+    # A reference that cannot be re-created would silently resolve to an unrelated relationship of the
+    # destination slide, so hyperlinks to such parts are dropped, and for anything else this returns False
+    # before touching the destination, for the caller to leave the shape out.
+    refs = [
+        (elem, attr, rId)
+        for elem in new_el.iter(etree.Element)
+        for attr, rId in elem.attrib.items()
+        # r:id="" marks an action hyperlink (next slide, end show, ...) with no target part
+        if attr.startswith(_R_NS) and rId
+    ]
+    rels = {rId: src_part.rels.get(rId) for _, _, rId in refs}
+    if any(not can_relate_in_destination(rels[rId]) and elem.tag not in _HYPERLINK_TAGS for elem, _, rId in refs):
+        return False
+    rId_map = {}
+    for elem, attr, old_rId in refs:
+        if not can_relate_in_destination(rels[old_rId]):
+            elem.getparent().remove(elem)
+            continue
+        if old_rId not in rId_map:
+            rId_map[old_rId] = relate_in_destination(rels[old_rId], dest_slide)
+        elem.set(attr, rId_map[old_rId])
+    return True
+
 # --- Helper Function for Copying Background (PPTX-specific) ---
+# Compiled once at import instead of once per .find() call with a freshly copied nsmap. The background can
+# only sit at p:cSld/p:bg, so the paths are anchored there rather than searching every shape on the slide.
+_BG_PR = etree.XPath('./p:cSld/p:bg/p:bgPr', namespaces=_NS)
+_BLIP_FILL = etree.XPath('./a:blipFill', namespaces=_NS)
+_BLIP = etree.XPath('./a:blip', namespaces=_NS)
+_R_EMBED = qn('r:embed')
+
+def _first(matches):
+    return matches[0] if matches else None
+
 def copy_slide_background(src_slide, dest_slide):
-    # This function remains unchanged
     src_slide_elm = src_slide.element
     dest_slide_elm = dest_slide.element
-    src_bg_pr = src_slide_elm.find('.//p:bgPr', namespaces=src_slide_elm.nsmap)
+    src_bg_pr = _first(_BG_PR(src_slide_elm))
     if src_bg_pr is None:
         return
-    src_blip_fill = src_bg_pr.find('.//a:blipFill', namespaces=src_slide_elm.nsmap)
+    src_blip_fill = _first(_BLIP_FILL(src_bg_pr))
     if src_blip_fill is not None:
-        src_blip = src_blip_fill.find('.//a:blip', namespaces=src_blip_fill.nsmap)
-        if src_blip is not None and '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed' in src_blip.attrib:
-            rId = src_blip.attrib['{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed']
+        src_blip = _first(_BLIP(src_blip_fill))
+        if src_blip is not None and _R_EMBED in src_blip.attrib:
+            rId = src_blip.attrib[_R_EMBED]
             try:
                 src_image_part = src_slide.part.related_part(rId)
-                image_bytes = src_image_part.blob
-                new_image_part = dest_slide.part.get_or_add_image_part(image_bytes, src_image_part.content_type)
-                new_rId = dest_slide.part.relate_to(new_image_part, 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image')
+                # Reuses an identical image part and relationship if one already exists
+                _, new_rId = get_or_add_copied_image_part(dest_slide, src_image_part)
                 new_bg_pr = copy.deepcopy(src_bg_pr)
-                new_blip = new_bg_pr.find('.//a:blip', namespaces=new_bg_pr.nsmap)
+                new_blip = _first(_BLIP(_BLIP_FILL(new_bg_pr)[0]))
                 if new_blip is not None:
-                    new_blip.attrib['{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed'] = new_rId
-                current_bg = dest_slide_elm.find('.//p:bg', namespaces=dest_slide_elm.nsmap)
-                if current_bg is not None:
-                    current_bg.getparent().remove(current_bg)
-                dest_slide_elm.append(new_bg_pr)
+                    new_blip.attrib[_R_EMBED] = new_rId
+                set_slide_background(dest_slide_elm, new_bg_pr)
             except Exception as e:
                 print(f"Warning: Could not copy background image. Error: {e}")
                 copy_solid_or_gradient_background(src_slide, dest_slide)
@@ -53,78 +195,125 @@ def copy_slide_background(src_slide, dest_slide):
         copy_solid_or_gradient_background(src_slide, dest_slide)
 
 def copy_solid_or_gradient_background(src_slide, dest_slide):
-    # This function remains unchanged
-    src_slide_elm = src_slide.element
-    dest_slide_elm = dest_slide.element
-    src_bg_pr = src_slide_elm.find('.//p:bgPr', namespaces=src_slide_elm.nsmap)
+    src_bg_pr = _first(_BG_PR(src_slide.element))
     if src_bg_pr is not None:
-        new_bg_pr = copy.deepcopy(src_bg_pr)
-        current_bg = dest_slide_elm.find('.//p:bg', namespaces=dest_slide_elm.nsmap)
-        if current_bg is not None:
-            current_bg.getparent().remove(current_bg)
-        dest_slide_elm.append(new_bg_pr)
+        set_slide_background(dest_slide.element, copy.deepcopy(src_bg_pr))
+
+def set_slide_background(dest_slide_elm, bg_pr):
+    # The properties belong in p:cSld/p:bg, which must be p:cSld's first child; get_or_add_bg puts a new one
+    # there. Whatever the destination's p:bg held before (a bgPr or a theme bgRef) is replaced.
+    bg = dest_slide_elm.cSld.get_or_add_bg()
+    bg.clear()
+    bg.append(bg_pr)
 
 # --- Core PowerPoint Functions (for PPTX output generation) ---
+_SP_TREE_SKELETON = frozenset((qn('p:nvGrpSpPr'), qn('p:grpSpPr'), qn('p:extLst')))
+
 def deep_copy_slide_content(dest_slide, src_slide):
-    # This function remains unchanged
-    for shape in list(dest_slide.shapes):
-        sp = shape.element
-        sp.getparent().remove(sp)
+    # Bind the python-pptx proxies once; every .shapes/.text_frame/.font access builds a fresh wrapper object
+    dest_shapes = dest_slide.shapes
+    sp_tree = dest_shapes._spTree
+    # One pass over spTree's children: everything but the group properties and extLst is shape content
+    for child in list(sp_tree):
+        if child.tag not in _SP_TREE_SKELETON:
+            sp_tree.remove(child)
+    # p:extLst never moves, so locate it once instead of scanning the tree for it on every fallback insert
+    ext_lst = sp_tree.find(qn('p:extLst'))
+    insert_shape_elm = ext_lst.addprevious if ext_lst is not None else sp_tree.append
     for shape in src_slide.shapes:
         left, top, width, height = shape.left, shape.top, shape.width, shape.height
         if shape.shape_type == MSO_SHAPE_TYPE.PICTURE:
             try:
-                image_bytes = shape.image.blob
-                dest_slide.shapes.add_picture(io.BytesIO(image_bytes), left, top, width, height)
+                add_picture(dest_slide, src_slide.part.related_part(shape._element.blip_rId), left, top, width, height)
             except Exception as e:
                 print(f"Warning: Could not copy picture from source slide. Error: {e}")
                 if hasattr(shape, 'is_placeholder') and shape.is_placeholder:
                     new_el = copy.deepcopy(shape.element)
-                    dest_slide.shapes._spTree.insert_element_before(new_el, 'p:extLst')
+                    if relate_copied_element(new_el, src_slide.part, dest_slide):
+                        insert_shape_elm(new_el)
         elif shape.has_text_frame:
-            new_shape = dest_slide.shapes.add_textbox(left, top, width, height)
-            new_text_frame = new_shape.text_frame
+            src_text_frame = shape.text_frame
+            new_text_frame = dest_shapes.add_textbox(left, top, width, height).text_frame
             new_text_frame.clear()
-            for paragraph in shape.text_frame.paragraphs:
+            for paragraph in src_text_frame.paragraphs:
                 new_paragraph = new_text_frame.add_paragraph()
-                new_paragraph.alignment = paragraph.alignment
-                if hasattr(paragraph, 'level'):
-                    new_paragraph.level = paragraph.level
+                # paragraph.alignment/.level and run.font go through get_or_add_pPr/get_or_add_rPr, which would insert
+                # empty property elements into the source; src_slide can belong to a cached deck shared by every session
+                pPr = paragraph._p.pPr
+                new_paragraph.alignment = pPr.algn if pPr is not None else None
+                new_paragraph.level = pPr.lvl if pPr is not None else 0
                 for run in paragraph.runs:
                     new_run = new_paragraph.add_run()
                     new_run.text = run.text
-                    new_run.font.bold = run.font.bold
-                    new_run.font.italic = run.font.italic
-                    new_run.font.underline = run.font.underline
-                    if run.font.size:
-                        new_run.font.size = run.font.size
-                    if run.font.fill.type == MSO_FILL_TYPE.SOLID:
-                        new_run.font.fill.solid()
+                    new_font = new_run.font
+                    rPr = run._r.rPr
+                    if rPr is None:
+                        continue
+                    font = Font(rPr)
+                    new_font.bold = font.bold
+                    new_font.italic = font.italic
+                    new_font.underline = font.underline
+                    size = font.size
+                    if size:
+                        new_font.size = size
+                    fill = font.fill
+                    if fill.type == MSO_FILL_TYPE.SOLID:
+                        new_fill = new_font.fill
+                        new_fill.solid()
                         try:
-                            if isinstance(run.font.fill.fore_color.rgb, RGBColor):
-                                new_run.font.fill.fore_color.rgb = run.font.fill.fore_color.rgb
+                            rgb = fill.fore_color.rgb
+                            if isinstance(rgb, RGBColor):
+                                new_fill.fore_color.rgb = rgb
                             else: 
-                                rgb_tuple = run.font.fill.fore_color.rgb
-                                new_run.font.fill.fore_color.rgb = RGBColor(rgb_tuple[0], rgb_tuple[1], rgb_tuple[2])
+                                new_fill.fore_color.rgb = RGBColor(rgb[0], rgb[1], rgb[2])
                         except Exception as color_e:
                             print(f"Warning: Could not copy font color. Error: {color_e}")
                             pass
-            new_text_frame.word_wrap = shape.text_frame.word_wrap
-            new_text_frame.margin_left = shape.text_frame.margin_left
-            new_text_frame.margin_right = shape.text_frame.margin_right
-            new_text_frame.margin_top = shape.text_frame.margin_top
-            new_text_frame.margin_bottom = shape.text_frame.margin_bottom
+            new_text_frame.word_wrap = src_text_frame.word_wrap
+            new_text_frame.margin_left = src_text_frame.margin_left
+            new_text_frame.margin_right = src_text_frame.margin_right
+            new_text_frame.margin_top = src_text_frame.margin_top
+            new_text_frame.margin_bottom = src_text_frame.margin_bottom
         else:
             new_el = copy.deepcopy(shape.element)
-            dest_slide.shapes._spTree.insert_element_before(new_el, 'p:extLst')
+            if relate_copied_element(new_el, src_slide.part, dest_slide):
+                insert_shape_elm(new_el)
+            else:
+                print(f"Warning: Skipped shape '{shape.name}', which refers to a part that cannot be copied into the new deck.")
     copy_slide_background(src_slide, dest_slide)
 
-def get_all_slide_data(file_bytes: bytes, file_type: str) -> list[dict]:
+def append_slide_copies(dest_prs, src_slides):
+    # Resolve the layout and the slide collection once for the whole batch rather than once per slide
+    layout = dest_prs.slide_layouts[0]
+    slides = dest_prs.slides
+    for src_slide in src_slides:
+        # Slides.add_slide would also clone the layout's placeholders, only for deep_copy_slide_content to remove
+        # them again; create the bare slide part and register it in the slide list directly instead
+        rId, dest_slide = slides.part.add_slide(layout)
+        slides._sldIdLst.add_sldId(rId)
+        deep_copy_slide_content(dest_slide, src_slide)
+
+def script_thread_pool(max_workers: int) -> ThreadPoolExecutor:
+    # st.cache_data only stores results computed on a thread that carries the script's run context
+    ctx = get_script_run_ctx()
+    return ThreadPoolExecutor(max_workers=max_workers, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx))
+
+def request_slide_data(file_bytes: bytes, file_type: str) -> list[dict]:
+    # Plain network call with no Streamlit calls, so it is safe to run from a worker thread
     files = {'file': (f"document.{file_type.split('/')[-1]}", file_bytes, file_type)}
+    response = requests.post(CONVERSION_SERVICE_URL, files=files, timeout=300)
+    response.raise_for_status()
+    slides = response.json()['slides']
+    # Build each thumbnail's data URL once, replacing the bare base64 so only one copy is held; every prompt
+    # then references the same string instead of formatting it again per request
+    for slide_info in slides:
+        image_type = slide_info.pop('image_type', "image/png")
+        slide_info['image_url'] = f"data:{image_type};base64," + slide_info.pop('image_data')
+    return slides
+
+def resolve_slide_data(fetch) -> list[dict]:
     try:
-        response = requests.post(CONVERSION_SERVICE_URL, files=files, timeout=300)
-        response.raise_for_status()
-        return response.json()['slides']
+        return fetch()
     except requests.exceptions.RequestException as e:
         st.error(f"Error connecting to conversion service or during conversion: {e}. Please ensure the conversion service is running at {CONVERSION_SERVICE_URL} and has required system dependencies (LibreOffice, PyMuPDF).")
         st.stop()
@@ -132,68 +321,207 @@ def get_all_slide_data(file_bytes: bytes, file_type: str) -> list[dict]:
         st.error("Conversion service returned an unexpected response format.")
         st.stop()
 
-def find_slide_by_ai(api_key, file_bytes: bytes, file_type: str, slide_type_prompt: str, deck_name: str):
-    if not slide_type_prompt: return {"slide": None, "index": -1, "justification": "No keyword provided."}
-    if not api_key:
-        return {"slide": None, "index": -1, "justification": "OpenAI API Key is missing."}
+def get_all_slide_data(file_hash: str, file_type: str, file_bytes: bytes) -> list[dict]:
+    return resolve_slide_data(lambda: load_slide_data(file_hash, file_type, file_bytes))
 
-    # --- START OF THE FIX ---
-    # Manually create an HTTP client with proxies explicitly disabled
+# --- OpenAI Access ---
+def api_key_fingerprint(api_key: str) -> str:
+    # Used in cache keys so the raw key never ends up in Streamlit's cache metadata
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def get_openai_client(key_fingerprint: str, _api_key: str):
+    # Manually create an HTTP client with proxies explicitly disabled.
+    # Cached per key so reruns reuse the same connection pool instead of opening a new one per call.
+    # openai and httpx take around half a second to import, so load them on first use rather than at startup
+    import httpx
+    import openai
     http_client = httpx.Client(proxies={})
-    client = openai.OpenAI(api_key=api_key, http_client=http_client)
-    # --- END OF THE FIX ---
-    
-    slides_data = get_all_slide_data(file_bytes, file_type)
-    system_prompt = f"""
-    You are an expert presentation analyst. Your task is to find the best slide/page in a document that matches a user's description.
-    The user is looking for a slide/page representing: '{slide_type_prompt}'.
+    return openai.OpenAI(api_key=_api_key, http_client=http_client)
+
+# Picking slide indices is a classification task the smaller model handles at a fraction of the latency and cost;
+# mapping rewrites content for regionalization, so it stays on the full model
+MATCHING_MODEL = "gpt-4o-mini"
+MAPPING_MODEL = "gpt-4o"
+# Decks longer than this are narrowed to the best text matches per keyword before being sent for matching
+PREFILTER_TOP_K = 15
+# Thumbnails are only used to judge a slide's layout, which the low-detail (512px) rendering shows well enough
+# at a fraction of the image tokens
+IMAGE_DETAIL = "low"
+# Structures with more steps than this are matched in several concurrent requests
+MATCHING_KEYWORDS_PER_REQUEST = 8
+_WORD = re.compile(r"\w+")
+
+# --- Structured Output Schemas ---
+# Strict schemas make the model return exactly these fields, so a malformed reply can't sink a step
+SLIDE_MATCHES_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "slide_matches",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "matches": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "description_index": {"type": "integer"},
+                            "best_match_index": {"type": "integer"},
+                            "justification": {"type": "string"},
+                        },
+                        "required": ["description_index", "best_match_index", "justification"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["matches"],
+            "additionalProperties": False,
+        },
+    },
+}
+TEMPLATE_MAPPING_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "template_mapping",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "best_template_index": {"type": "integer"},
+                "justification": {"type": "string"},
+                "processed_content": {
+                    "type": "object",
+                    "properties": {
+                        "title": {"type": "string"},
+                        "body": {"type": "string"},
+                    },
+                    "required": ["title", "body"],
+                    "additionalProperties": False,
+                },
+            },
+            "required": ["best_template_index", "justification", "processed_content"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def request_json_completion(key_fingerprint: str, model: str, messages: list, response_format: dict, _api_key: str) -> dict:
+    # Identical prompts (same key, model and messages) are answered from the cache across reruns.
+    # Exceptions are not cached, so API and JSON errors still reach the caller every time.
+    client = get_openai_client(key_fingerprint, _api_key)
+    response = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        response_format=response_format
+    )
+    return json.loads(response.choices[0].message.content)
+
+def prefilter_slides(slides_data: list[dict], queries: list[str], top_k: int = PREFILTER_TOP_K) -> list[dict]:
+    # Rank slides against each query with a small TF-IDF score and keep the top_k per query, so long decks
+    # only send plausible candidates to the model. Falls back to the whole deck when a query matches no slide text.
+    if len(slides_data) <= top_k:
+        return slides_data
+    docs = [Counter(_WORD.findall(slide_info["text"].lower())) for slide_info in slides_data]
+    doc_lengths = [sum(doc.values()) or 1 for doc in docs]
+    document_frequency = Counter(term for doc in docs for term in doc)
+    idf = {term: math.log(len(docs) / count) + 1 for term, count in document_frequency.items()}
+    keep = set()
+    for query in queries:
+        terms = idf.keys() & set(_WORD.findall(query.lower()))
+        scores = [sum(doc[term] * idf[term] for term in terms) / length for doc, length in zip(docs, doc_lengths)]
+        if not any(scores):
+            return slides_data
+        keep.update(sorted(range(len(docs)), key=scores.__getitem__, reverse=True)[:top_k])
+    return [slides_data[i] for i in sorted(keep)]
+
+def slide_summary_parts(slides_data: list[dict], label: str) -> list[dict]:
+    # Text plus thumbnail per slide. A thumbnail repeated on several slides (blank or divider pages, shared
+    # backgrounds) is attached once and referred to by slide number afterwards, since every image costs tokens.
+    parts = []
+    first_slide_by_image = {}
+    for slide_info in slides_data:
+        slide_number = slide_info['slide_index'] + 1
+        same_as = first_slide_by_image.setdefault(slide_info['image_url'], slide_number)
+        if same_as != slide_number:
+            parts.append({"type": "text", "text": f"\n--- {label} {slide_number} (Text): {slide_info['text']} (Visual: same as {label} {same_as})"})
+            continue
+        parts.append({"type": "text", "text": f"\n--- {label} {slide_number} (Text): {slide_info['text']}"})
+        parts.append({
+            "type": "image_url",
+            "image_url": { "url": slide_info['image_url'], "detail": IMAGE_DETAIL }
+        })
+    return parts
+
+def find_slides_by_ai(api_key, slides_data: list[dict], slide_type_prompts: list[str], deck_name: str) -> dict:
+    # Keywords are matched together (in chunks for long structures), so the deck is not sent once per step
+    import openai
+    def no_match(justification):
+        return {"slide": None, "index": -1, "justification": justification}
+
+    results = {"": no_match("No keyword provided.")} if "" in slide_type_prompts else {}
+    keywords = list(dict.fromkeys(prompt for prompt in slide_type_prompts if prompt))
+    if not keywords: return results
+    if not api_key:
+        results.update({keyword: no_match("OpenAI API Key is missing.") for keyword in keywords})
+        return results
+
+    system_prompt = """
+    You are an expert presentation analyst. Your task is to find the best slide/page in a document for each of a user's descriptions.
     Analyze both the provided **text content** and the **visual structure (from the image)** for each slide/page to infer its purpose.
     For 'Timeline' slides/pages: Look for strong textual indicators of sequential progression and visual patterns that imply a timeline.
     For 'Objectives' slides/pages: These will typically contain goal-oriented language.
     You must prioritize actual content slides/pages over simple divider or table of contents pages.
-    Return a JSON object with 'best_match_index' (integer, or -1) and 'justification' (brief, one-sentence).
+    Return a JSON object with a 'matches' list holding one entry per description, each with 'description_index' (the number the description is listed under), 'best_match_index' (integer, or -1) and 'justification' (brief, one-sentence).
     """
-    user_parts = [
-        {"type": "text", "text": f"Find the best slide/page for '{slide_type_prompt}' in the '{deck_name}' with the following pages/slides:"}
-    ]
-    for slide_info in slides_data:
-        user_parts.append({"type": "text", "text": f"\n--- Page/Slide {slide_info['slide_index'] + 1} (Text): {slide_info['text']}"})
-        user_parts.append({
-            "type": "image_url",
-            "image_url": { "url": f"data:image/png;base64,{slide_info['image_data']}" }
-        })
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_parts}
-    ]
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            response_format={"type": "json_object"}
-        )
-        result = json.loads(response.choices[0].message.content)
-        best_index = result.get("best_match_index", -1)
-        justification = result.get("justification", "No justification provided.")
-        selected_slide_data = slides_data[best_index] if best_index != -1 and best_index < len(slides_data) else None
-        return {"slide": selected_slide_data, "index": best_index, "justification": justification}
-    except openai.APIError as e:
-        return {"slide": None, "index": -1, "justification": f"OpenAI API Error: {e}"}
-    except json.JSONDecodeError as e:
-        return {"slide": None, "index": -1, "justification": f"AI response was not valid JSON: {e}"}
-    except Exception as e:
-        return {"slide": None, "index": -1, "justification": f"An unexpected error occurred during AI analysis: {e}"}
 
-def analyze_and_map_content(api_key, gtm_slide_content_data, template_slides_data, user_keyword):
-    if not api_key:
-        return {"best_template_index": -1, "justification": "OpenAI API Key is missing.", "processed_content": gtm_slide_content_data}
+    def match_keywords(chunk):
+        candidate_slides = prefilter_slides(slides_data, chunk)
+        # The deck goes first and the descriptions last, so editing the structure still reuses OpenAI's cached deck prefix
+        slide_parts = [
+            {"type": "text", "text": f"The '{deck_name}' has the following pages/slides:"}
+        ]
+        slide_parts.extend(slide_summary_parts(candidate_slides, "Page/Slide"))
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": slide_parts},
+            {"role": "user", "content": "Find the best slide/page for each of these descriptions:\n" + "\n".join(f"{n}. {keyword}" for n, keyword in enumerate(chunk, 1))}
+        ]
+        chunk_results = {}
+        try:
+            result = request_json_completion(api_key_fingerprint(api_key), MATCHING_MODEL, messages, SLIDE_MATCHES_FORMAT, api_key)
+            # Joined on the description's number rather than its text, which the model does not always echo back verbatim
+            matches = {match["description_index"]: match for match in result["matches"]}
+            candidates_by_index = {slide_info["slide_index"]: slide_info for slide_info in candidate_slides}
+            for n, keyword in enumerate(chunk, 1):
+                if n not in matches:
+                    chunk_results[keyword] = no_match("No justification provided.")
+                    continue
+                best_index = matches[n]["best_match_index"]
+                selected_slide_data = candidates_by_index.get(best_index)
+                chunk_results[keyword] = {"slide": selected_slide_data, "index": best_index, "justification": matches[n]["justification"]}
+        except openai.APIError as e:
+            chunk_results.update({keyword: no_match(f"OpenAI API Error: {e}") for keyword in chunk})
+        except json.JSONDecodeError as e:
+            chunk_results.update({keyword: no_match(f"AI response was not valid JSON: {e}") for keyword in chunk})
+        except Exception as e:
+            chunk_results.update({keyword: no_match(f"An unexpected error occurred during AI analysis: {e}") for keyword in chunk})
+        return chunk_results
 
-    # --- START OF THE FIX ---
-    # Manually create an HTTP client with proxies explicitly disabled
-    http_client = httpx.Client(proxies={})
-    client = openai.OpenAI(api_key=api_key, http_client=http_client)
-    # --- END OF THE FIX ---
+    # Reply time grows with the number of justifications to write, so long structures are matched in a few
+    # concurrent requests instead of one long one
+    chunks = [keywords[i:i + MATCHING_KEYWORDS_PER_REQUEST] for i in range(0, len(keywords), MATCHING_KEYWORDS_PER_REQUEST)]
+    if len(chunks) == 1:
+        results.update(match_keywords(chunks[0]))
+    else:
+        with script_thread_pool(min(8, len(chunks))) as pool:
+            for chunk_results in pool.map(match_keywords, chunks):
+                results.update(chunk_results)
+    return results
 
+def build_mapping_messages(gtm_slide_content_data, template_slides_data, user_keyword) -> list:
     system_prompt = f"""
     You are an expert presentation content mapper. Your primary task is to help a user integrate content from a Global (GTM) slide/page into the most appropriate regional template.
     Given the `gtm_slide_content` (with its text and image) and a list of `template_slides_data` (each with an index and text content, and image data), you must perform two critical tasks:
@@ -201,38 +529,39 @@ def analyze_and_map_content(api_key, gtm_slide_content_data, template_slides_dat
     2. Process GTM Content for Regionalization: Analyze the `gtm_slide_content` and replace any regional-specific parts with a generic placeholder like `[REGIONAL DATA HERE]`.
     You MUST return a JSON object with 'best_template_index' (integer), 'justification' (string), and 'processed_content' (object with 'title' and 'body').
     """
-    user_parts = [
+    # The template slides are the same for every step, so send them first: OpenAI caches repeated prompt
+    # prefixes, and only the short step-specific message after them changes between calls
+    template_parts = [{"type": "text", "text": "Available Template Slides/Pages Summary and Visuals:"}]
+    template_parts.extend(slide_summary_parts(template_slides_data, "Template Slide/Page"))
+    step_parts = [
         {"type": "text", "text": f"User's original keyword for this content: '{user_keyword}'"},
         {"type": "text", "text": "GTM Slide/Page Content to Process (Text):"},
-        {"type": "text", "text": json.dumps(gtm_slide_content_data.get('text', {}), indent=2)},
-        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{gtm_slide_content_data['image_data']}"}} 
+        {"type": "text", "text": json.dumps({"title": gtm_slide_content_data.get("title", ""), "body": gtm_slide_content_data.get("body", "")}, ensure_ascii=False, separators=(",", ":"))},
     ]
-    user_parts.append({"type": "text", "text": "\nAvailable Template Slides/Pages Summary and Visuals:"})
-    for slide_info in template_slides_data:
-        user_parts.append({"type": "text", "text": f"\n--- Template Slide/Page {slide_info['slide_index'] + 1} (Text): {slide_info['text']}"})
-        user_parts.append({
-            "type": "image_url",
-            "image_url": { "url": f"data:image/png;base64,{slide_info['image_data']}" }
-        })
-    messages = [
+    # Only attach the GTM visual when a slide was actually selected; with no match there is no image to look at
+    if gtm_slide_content_data.get("image_url"):
+        step_parts.append({"type": "image_url", "image_url": {"url": gtm_slide_content_data["image_url"], "detail": IMAGE_DETAIL}})
+    return [
         {"role": "system", "content": system_prompt},
-        {"role": "user", "content": user_parts}
+        {"role": "user", "content": template_parts},
+        {"role": "user", "content": step_parts}
     ]
+
+def parse_mapping_result(result: dict) -> dict:
+    # TEMPLATE_MAPPING_FORMAT guarantees every field, including the title and body of processed_content
+    if "best_template_index" not in result or "justification" not in result or "processed_content" not in result:
+        raise ValueError("AI response missing required keys.")
+    return {"best_template_index": result["best_template_index"], "justification": result["justification"], "processed_content": result["processed_content"]}
+
+def analyze_and_map_content(api_key, gtm_slide_content_data, template_slides_data, user_keyword):
+    import openai
+    if not api_key:
+        return {"best_template_index": -1, "justification": "OpenAI API Key is missing.", "processed_content": gtm_slide_content_data}
+
+    messages = build_mapping_messages(gtm_slide_content_data, template_slides_data, user_keyword)
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            response_format={"type": "json_object"}
-        )
-        result = json.loads(response.choices[0].message.content)
-        if "best_template_index" not in result or "justification" not in result or "processed_content" not in result:
-            raise ValueError("AI response missing required keys.")
-        best_index = result["best_template_index"]
-        justification = result["justification"]
-        processed_content = result["processed_content"]
-        if "title" not in processed_content: processed_content["title"] = gtm_slide_content_data.get("title", "")
-        if "body" not in processed_content: processed_content["body"] = gtm_slide_content_data.get("body", "")
-        return {"best_template_index": best_index, "justification": justification, "processed_content": processed_content}
+        result = request_json_completion(api_key_fingerprint(api_key), MAPPING_MODEL, messages, TEMPLATE_MAPPING_FORMAT, api_key)
+        return parse_mapping_result(result)
     except openai.APIError as e:
         print(f"OpenAI API Error in analyze_and_map_content: {e}")
         return {"best_template_index": -1, "justification": f"OpenAI API Error: {e}", "processed_content": gtm_slide_content_data}
@@ -243,51 +572,278 @@ def analyze_and_map_content(api_key, gtm_slide_content_data, template_slides_dat
         print(f"An unexpected error occurred in analyze_and_map_content: {e}")
         return {"best_template_index": -1, "justification": f"An error occurred during content mapping: {e}", "processed_content": gtm_slide_content_data}
 
-def get_slide_content(slide):
-    # This function remains unchanged
-    if not slide: return {"title": "", "body": ""}
-    text_shapes = sorted([s for s in slide.shapes if s.has_text_frame and s.text.strip()], key=lambda s: s.top)
-    title = ""
-    body = ""
-    if text_shapes:
-        title = text_shapes[0].text.strip()
-        body = "\n".join(s.text.strip() for s in text_shapes[1:])
-    return {"title": title, "body": body}
+def needs_mapping(step, gtm_is_pptx) -> bool:
+    return not (step["action"] == "Copy from GTM (as is)" and gtm_is_pptx)
+
+def raw_content_from_selection(selection):
+    raw_gtm_content = {"title": "", "body": ""}
+    if selection["slide"]:
+        full_text = selection["slide"].get("text", "")
+        lines = full_text.split('\n')
+        raw_gtm_content["title"] = lines[0] if lines else ""
+        raw_gtm_content["body"] = "\n".join(lines[1:]) if len(lines) > 1 else ""
+        raw_gtm_content["image_url"] = selection["slide"].get("image_url")
+    return raw_gtm_content
+
+def run_step_ai(api_key, step, selection, gtm_is_pptx, template_slides_data):
+    # Makes no Streamlit calls, so every step of the structure can be resolved in its own worker thread
+    if not needs_mapping(step, gtm_is_pptx):
+        return {"selection": selection, "mapping": None}
+    mapping = analyze_and_map_content(api_key, raw_content_from_selection(selection), template_slides_data, step["keyword"])
+    return {"selection": selection, "mapping": mapping}
+
+# --- OpenAI Batch Mode ---
+BATCH_FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+def start_batch(api_key, jsonl_bytes: bytes) -> str:
+    # Batch requests cost half as much but can take up to the full completion window to finish
+    client = get_openai_client(api_key_fingerprint(api_key), api_key)
+    batch_file = client.files.create(file=("requests.jsonl", jsonl_bytes), purpose="batch")
+    return client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h").id
+
+def retrieve_batch(api_key, batch_id: str):
+    return get_openai_client(api_key_fingerprint(api_key), api_key).batches.retrieve(batch_id)
+
+def read_batch_results(api_key, batch) -> dict:
+    import openai
+    if batch.status != "completed" or not batch.output_file_id:
+        raise openai.OpenAIError(f"Batch {batch.id} finished with status '{batch.status}'.")
+    client = get_openai_client(api_key_fingerprint(api_key), api_key)
+    results = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        record = json.loads(line)
+        response = record.get("response") or {}
+        if response.get("status_code") == 200:
+            results[record["custom_id"]] = json.loads(response["body"]["choices"][0]["message"]["content"])
+    return results
+
+def run_steps_ai_in_batch(api_key, steps, selections, gtm_is_pptx, template_slides_data) -> list[dict] | None:
+    # Returns None while the batch is still running. The batch id lives in session state rather than in this run,
+    # so later reruns check on the same batch instead of paying for a new one
+    step_results = [{"selection": selections[step["keyword"]], "mapping": None} for step in steps]
+    raw_contents = {}
+    # Steps sharing a keyword would send identical requests; only the first is submitted and the rest reuse its result
+    first_step_by_keyword = {}
+    lines = []
+    for i, step in enumerate(steps):
+        if not needs_mapping(step, gtm_is_pptx):
+            continue
+        if first_step_by_keyword.setdefault(step["keyword"], i) != i:
+            continue
+        raw_contents[i] = raw_content_from_selection(step_results[i]["selection"])
+        messages = build_mapping_messages(raw_contents[i], template_slides_data, step["keyword"])
+        lines.append(json.dumps({
+            "custom_id": f"step-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": MAPPING_MODEL, "response_format": TEMPLATE_MAPPING_FORMAT, "messages": messages}
+        }, separators=(",", ":")))
+    if not lines:
+        return step_results
+    jsonl_bytes = "\n".join(lines).encode("utf-8")
+    # Identical requests hash the same, so an unchanged structure picks the pending batch back up
+    requests_digest = file_digest(jsonl_bytes)
+    pending = st.session_state.get("pending_batch")
+    try:
+        if pending is None or pending["digest"] != requests_digest:
+            if pending is not None:
+                try:
+                    get_openai_client(api_key_fingerprint(api_key), api_key).batches.cancel(pending["id"])
+                except Exception as e:
+                    print(f"Warning: Could not cancel superseded batch {pending['id']}. Error: {e}")
+            pending = {"id": start_batch(api_key, jsonl_bytes), "digest": requests_digest,
+                       "keywords": {f"step-{i}": steps[i]["keyword"] for i in raw_contents}}
+            st.session_state.pending_batch = pending
+        batch = retrieve_batch(api_key, pending["id"])
+        if batch.status not in BATCH_FINAL_STATUSES:
+            return None
+        st.session_state.pop("pending_batch", None)
+        results_by_custom_id = read_batch_results(api_key, batch)
+    except Exception as e:
+        st.session_state.pop("pending_batch", None)
+        results_by_custom_id = {}
+        batch_error = f"Batch request failed: {e}"
+    else:
+        batch_error = "Batch request returned no result for this step."
+    batch_results = {pending["keywords"][custom_id]: result for custom_id, result in results_by_custom_id.items()
+                     if custom_id in pending["keywords"]}
+    for i, raw_gtm_content in raw_contents.items():
+        try:
+            if steps[i]["keyword"] not in batch_results:
+                raise ValueError(batch_error)
+            step_results[i]["mapping"] = parse_mapping_result(batch_results[steps[i]["keyword"]])
+        except Exception as e:
+            step_results[i]["mapping"] = {"best_template_index": -1, "justification": f"An error occurred during content mapping: {e}", "processed_content": raw_gtm_content}
+    for i, step in enumerate(steps):
+        if needs_mapping(step, gtm_is_pptx):
+            step_results[i]["mapping"] = step_results[first_step_by_keyword[step["keyword"]]]["mapping"]
+    return step_results
+
+def batch_is_ready(api_key) -> bool:
+    # A single status check, so a rerun with a batch in flight returns straight away instead of rebuilding the deck
+    try:
+        batch = retrieve_batch(api_key, st.session_state.pending_batch["id"])
+    except Exception as e:
+        st.warning(f"Could not check the OpenAI batch status: {e}")
+        return False
+    if batch.status in BATCH_FINAL_STATUSES:
+        return True
+    counts = batch.request_counts
+    st.info(f"OpenAI batch {batch.id}: {batch.status}" + (f" ({counts.completed}/{counts.total} requests done)." if counts else "."))
+    st.button("Check batch status")
+    return False
+
+def set_text_frame_text(text_frame, text):
+    # Same result as text_frame.clear() plus a new one-run paragraph, but done on the txBody element
+    # directly so no Paragraph wrappers are built just to empty them
+    tx_body = text_frame._txBody
+    paragraphs = tx_body.findall(_A_P)
+    for p in paragraphs[1:]:
+        tx_body.remove(p)
+    if paragraphs:
+        etree.strip_elements(paragraphs[0], _A_R, _A_BR, _A_FLD, with_tail=False)
+    # Build <a:p><a:r><a:t> with the oxml element API rather than the _Paragraph/_Run wrappers;
+    # the a:r text setter still escapes control characters exactly as run.text would
+    tx_body.add_p().add_r().text = text
 
 def populate_slide(slide, content):
-    # This function remains unchanged
     title_populated, body_populated = False, False
+    lorem_sps = set(LOREM_XPATH(slide.element))
+    # One XPath pass maps each placeholder <p:sp> to its type, instead of building a placeholder_format per shape
+    placeholder_types = {ph.getparent().getparent().getparent(): ph.type for ph in _PLACEHOLDERS(slide.element)}
     for shape in slide.shapes:
         if not shape.has_text_frame: continue
-        is_title_placeholder = (hasattr(shape, 'is_placeholder') and shape.is_placeholder and shape.placeholder_format.type in (1, 2, 8))
-        is_top_text_box = (shape.top < Pt(150))
-        if not title_populated and (is_title_placeholder or is_top_text_box):
-            tf = shape.text_frame
-            tf.clear()
-            p = tf.add_paragraph()
-            run = p.add_run()
-            run.text = content.get("title", "")
+        ph_type = placeholder_types.get(shape.element)
+        # shape.top may have to resolve an inherited layout position, so only read it while still looking for a title
+        if not title_populated and (ph_type in _TITLE_PH_TYPES or shape.top < _TITLE_TOP_LIMIT):
+            title = content.get("title", "")
+            set_text_frame_text(shape.text_frame, title)
             title_populated = True
-        is_body_placeholder = (hasattr(shape, 'is_placeholder') and shape.is_placeholder and shape.placeholder_format.type in (3, 4, 8, 14))
-        is_lorem_ipsum = "lorem ipsum" in shape.text.lower()
-        is_empty_text_box = not shape.text.strip() and shape.height > Pt(100)
-        if not body_populated and (is_body_placeholder or is_lorem_ipsum or is_empty_text_box):
-            tf = shape.text_frame
-            tf.clear()
-            p = tf.add_paragraph()
-            run = p.add_run()
-            run.text = content.get("body", "")
+            # lorem_sps describes the slide before any writes: the shape now holds just the title, so it counts as
+            # lorem filler exactly when the title itself does (the old code re-read shape.text at this point)
+            if "lorem ipsum" in title.lower():
+                lorem_sps.add(shape.element)
+            else:
+                lorem_sps.discard(shape.element)
+        # Cheapest checks first: the text is only gathered when the XPath lookups miss, and straight from the XML
+        if not body_populated and (
+            ph_type in _BODY_PH_TYPES
+            or shape.element in lorem_sps
+            or (not element_text(shape.element).strip() and shape.height > _MIN_BODY_HEIGHT)
+        ):
+            set_text_frame_text(shape.text_frame, content.get("body", ""))
             body_populated = True
         if title_populated and body_populated:
             break
 
+# --- Package Saving ---
+# Media parts are already compressed, so deflating them again only burns CPU; XML is deflated at the fastest level
+_PRECOMPRESSED_EXTS = frozenset({"png", "jpg", "jpeg", "gif", "wdp", "mp3", "m4a", "mp4", "m4v"})
+
+class _FastZipPkgWriter(_ZipPkgWriter):
+    def write(self, pack_uri, blob):
+        if pack_uri.ext.lower() in _PRECOMPRESSED_EXTS:
+            self._zipf.writestr(pack_uri.membername, blob, compress_type=zipfile.ZIP_STORED)
+        else:
+            self._zipf.writestr(pack_uri.membername, blob, compresslevel=1)
+
+class _FastPackageWriter(PackageWriter):
+    def _write(self):
+        with _FastZipPkgWriter(self._pkg_file) as phys_writer:
+            self._write_content_types_stream(phys_writer)
+            self._write_pkg_rels(phys_writer)
+            self._write_parts(phys_writer)
+
+def save_presentation(prs, pkg_file):
+    package = prs.part.package
+    _FastPackageWriter.write(pkg_file, package._rels, tuple(package.iter_parts()))
+
+# --- Cached Loaders ---
+def file_digest(file_bytes: bytes) -> str:
+    return hashlib.blake2b(file_bytes, digest_size=16).hexdigest()
+
+def upload_digest(uploaded_file) -> str:
+    # An upload keeps its file_id for as long as it stays in the widget, so every rerun (each widget edit)
+    # reuses the digest instead of hashing the whole file again
+    digests = st.session_state.setdefault("upload_digests", {})
+    if uploaded_file.file_id not in digests:
+        digests[uploaded_file.file_id] = file_digest(uploaded_file.getvalue())
+    return digests[uploaded_file.file_id]
+
+@st.cache_resource(show_spinner=False, max_entries=16, ttl=3600)
+def load_pptx(file_hash: str, _file_bytes: bytes):
+    # The same Presentation object is handed to every session and rerun, so only use this for decks that are read
+    # from; deep_copy_slide_content takes care to never write to its source slide
+    return Presentation(io.BytesIO(_file_bytes))
+
+# Prefetched conversions not yet collected by an assembly; past this many the oldest are forgotten
+MAX_PENDING_PREFETCHES = 16
+
+@st.cache_resource(show_spinner=False)
+def slide_data_prefetcher() -> tuple[ThreadPoolExecutor, OrderedDict]:
+    # A plain pool shared by every session, with no script run context on its threads: they only run
+    # request_slide_data, never a Streamlit-cached function, so they cannot interfere with widgets rendered
+    # while a conversion is in flight. Pending maps an upload's digest to the Future of its conversion.
+    return ThreadPoolExecutor(max_workers=8), OrderedDict()
+
+@st.cache_data(show_spinner=False, max_entries=32, ttl=3600)
+def load_slide_data(file_hash: str, file_type: str, _file_bytes: bytes) -> list[dict]:
+    # Keyed on the content hash so re-running an assembly with the same uploads skips the conversion service.
+    # A conversion prefetched when the file was uploaded is collected (and waited for) instead of sent again
+    future = slide_data_prefetcher()[1].pop(file_hash, None)
+    if future is not None:
+        return future.result()
+    return request_slide_data(_file_bytes, file_type)
+
+def prefetch_slide_data(uploaded_files):
+    # Warm load_slide_data as soon as files are uploaded, once per file; failures are reported when assembling
+    attempted = st.session_state.setdefault("prefetched_files", set())
+    uploads = []
+    for f in uploaded_files:
+        if f.type != 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
+            continue
+        file_hash = upload_digest(f)
+        if file_hash not in attempted:
+            attempted.add(file_hash)
+            uploads.append((file_hash, f.type, f.getvalue()))
+    if not uploads:
+        return
+    # Submitted without waiting, so the sidebar renders while the conversions run
+    pool, pending = slide_data_prefetcher()
+    for file_hash, file_type, file_bytes in uploads:
+        if file_hash not in pending:
+            pending[file_hash] = pool.submit(request_slide_data, file_bytes, file_type)
+    # popitem is atomic, so sessions prefetching at the same time can trim the shared dict safely
+    while len(pending) > MAX_PENDING_PREFETCHES:
+        try:
+            pending.popitem(last=False)
+        except KeyError:
+            break
+
 # --- Streamlit App ---
+@st.experimental_fragment
+def render_structure_step(i, step):
+    # Editing a step only reruns this fragment; deleting one changes the list, so that still reruns the whole app
+    with st.container(border=True):
+        cols = st.columns([3, 3, 1])
+        step["keyword"] = cols[0].text_input("Slide Type", step["keyword"], key=f"keyword_{step['id']}")
+        step["action"] = cols[1].selectbox(
+            "Action", 
+            ["Copy from GTM (as is)", "Merge: Template Layout + GTM Content"], 
+            index=["Copy from GTM (as is)", "Merge: Template Layout + GTM Content"].index(step["action"]), 
+            key=f"action_{step['id']}"
+        )
+        if cols[2].button("🗑️", key=f"del_{step['id']}"):
+            st.session_state.structure.pop(i)
+            st.rerun()
+
 st.set_page_config(page_title="Dynamic AI Presentation Assembler", layout="wide")
 st.title("📊 Dynamic AI Presentation Assembler")
 
 with st.sidebar:
     st.header("1. API Key")
     api_key = st.text_input("OpenAI API Key", type="password")
+    batch_mode = st.toggle("Batch mode", help="Send the template mapping requests through the OpenAI Batch API: half the cost, but the batch can take up to 24 hours. The assembly finishes on a later rerun once it completes.")
     st.markdown("---")
     st.header("2. Input Documents (Drag & Drop)")
     st.info("Upload your PPTX or PDF files directly.")
@@ -305,6 +861,7 @@ with st.sidebar:
         accept_multiple_files=False,
         key="gtm_uploader"
     )
+    prefetch_slide_data((uploaded_template_files or []) + ([uploaded_gtm_file] if uploaded_gtm_file else []))
     st.markdown("---")
     st.header("3. Define Presentation Structure")
     if 'structure' not in st.session_state: 
@@ -312,47 +869,58 @@ with st.sidebar:
     if st.button("Add New Step", use_container_width=True):
         st.session_state.structure.append({"id": str(uuid.uuid4()), "keyword": "", "action": "Copy from GTM (as is)"})
     for i, step in enumerate(st.session_state.structure):
-        with st.container(border=True):
-            cols = st.columns([3, 3, 1])
-            step["keyword"] = cols[0].text_input("Slide Type", step["keyword"], key=f"keyword_{step['id']}")
-            step["action"] = cols[1].selectbox(
-                "Action", 
-                ["Copy from GTM (as is)", "Merge: Template Layout + GTM Content"], 
-                index=["Copy from GTM (as is)", "Merge: Template Layout + GTM Content"].index(step["action"]), 
-                key=f"action_{step['id']}"
-            )
-            if cols[2].button("🗑️", key=f"del_{step['id']}"):
-                st.session_state.structure.pop(i)
-                st.rerun()
+        render_structure_step(i, step)
     if st.button("Clear Structure", use_container_width=True): 
         st.session_state.structure = []
         st.rerun()
 
+@st.experimental_fragment
+def render_download():
+    # The deck lives in session state (per user, unlike cache_resource), so it survives later reruns; clicking
+    # the download button only reruns this fragment instead of the whole app
+    st.success("✨ Your new regional presentation has been assembled!")
+    st.download_button(
+        "Download Assembled PowerPoint", 
+        data=st.session_state.assembled_deck, 
+        file_name="Dynamic_AI_Assembled_Deck.pptx",
+        mime="application/vnd.openxmlformats-officedocument.presentationml.presentation"
+    )
+
 # --- Main App Logic ---
 if uploaded_template_files and uploaded_gtm_file and api_key and st.session_state.structure:
-    if st.button("🚀 Assemble Presentation", type="primary"):
+    assemble_clicked = st.button("🚀 Assemble Presentation", type="primary")
+    # A pending batch resumes the assembly on a later rerun, once its status check finds it finished
+    if assemble_clicked or (batch_mode and "pending_batch" in st.session_state and batch_is_ready(api_key)):
         with st.spinner("Assembling your new presentation..."):
+            step_pool = None
             try:
+                # Release the previous result before building a new one so two decks are never held at once
+                st.session_state.pop("assembled_deck", None)
                 st.write("Step 1/3: Loading and processing uploaded documents...")
                 all_template_slides_for_ai = []
                 base_pptx_template_found = False
                 new_prs = None 
-                for uploaded_file in uploaded_template_files:
-                    file_bytes = uploaded_file.read()
-                    file_type = uploaded_file.type
-                    file_name = uploaded_file.name
-                    if file_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
-                        if not base_pptx_template_found:
-                            new_prs = Presentation(io.BytesIO(file_bytes))
-                            st.info(f"Using '{file_name}' as the primary base PPTX template.")
-                            base_pptx_template_found = True
-                        else:
-                            current_prs_to_merge = Presentation(io.BytesIO(file_bytes))
-                            st.info(f"Merging slides from '{file_name}' into the base template.")
-                            for slide_to_merge in current_prs_to_merge.slides:
-                                new_slide = new_prs.slides.add_slide(new_prs.slide_layouts[0]) 
-                                deep_copy_slide_content(new_slide, slide_to_merge) 
-                    all_template_slides_for_ai.extend(get_all_slide_data(file_bytes, file_type))
+                # Hash each upload once; the digest keys both the parsed-deck and the slide-data caches
+                template_uploads = []
+                for f in uploaded_template_files:
+                    file_bytes = f.read()
+                    template_uploads.append((file_bytes, upload_digest(f), f.type, f.name))
+                # Conversion requests are network-bound: start them all at once and parse the PPTX decks while they run
+                with script_thread_pool(min(8, len(template_uploads))) as pool:
+                    slide_data_futures = [pool.submit(load_slide_data, file_hash, file_type, file_bytes) for file_bytes, file_hash, file_type, _ in template_uploads]
+                    for file_bytes, file_hash, file_type, file_name in template_uploads:
+                        if file_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
+                            if not base_pptx_template_found:
+                                # The base deck gets modified, so it is parsed fresh rather than taken from the shared cache
+                                new_prs = Presentation(io.BytesIO(file_bytes))
+                                st.info(f"Using '{file_name}' as the primary base PPTX template.")
+                                base_pptx_template_found = True
+                            else:
+                                current_prs_to_merge = load_pptx(file_hash, file_bytes)
+                                st.info(f"Merging slides from '{file_name}' into the base template.")
+                                append_slide_copies(new_prs, current_prs_to_merge.slides)
+                    for future in slide_data_futures:
+                        all_template_slides_for_ai.extend(resolve_slide_data(future.result))
                 if new_prs is None:
                     st.error("Error: At least one PPTX file must be uploaded as a 'Template Document' to serve as the base for the assembled presentation.")
                     st.stop() 
@@ -365,18 +933,46 @@ if uploaded_template_files and uploaded_gtm_file and api_key and st.session_stat
                 num_template_slides = len(new_prs.slides) 
                 num_structure_steps = len(st.session_state.structure)
                 if num_structure_steps < num_template_slides:
-                    for i in range(num_template_slides - 1, num_structure_steps - 1, -1):
-                        rId = new_prs.slides._sldIdLst[i].rId
-                        new_prs.part.drop_rel(rId)
-                        del new_prs.slides._sldIdLst[i]
+                    # Cut the unused tail of sldIdLst in one slice, then drop the orphaned relationships against a
+                    # single scan of presentation.xml (drop_rel rescans the whole document for every rId it checks)
+                    sld_id_lst = new_prs.slides._sldIdLst
+                    dropped_rIds = [sld_id.rId for sld_id in sld_id_lst[num_structure_steps:]]
+                    del sld_id_lst[num_structure_steps:]
+                    referenced_rIds = set(new_prs.part._element.xpath("//@r:id"))
+                    for rId in dropped_rIds:
+                        if rId not in referenced_rIds:
+                            new_prs.part.rels.pop(rId)
                     st.info(f"Removed {num_template_slides - num_structure_steps} unused slides from the merged template.")
                 elif num_structure_steps > num_template_slides:
                      st.warning(f"Warning: Your defined structure has more steps ({num_structure_steps}) than the merged template has slides ({num_template_slides}). Extra steps will be ignored.")
 
-                for i, step in enumerate(st.session_state.structure):
-                    if i >= len(new_prs.slides): 
-                        break
+                gtm_is_pptx = gtm_file_to_process_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
+                gtm_file_to_process_hash = upload_digest(uploaded_gtm_file)
+                gtm_slides_data = get_all_slide_data(gtm_file_to_process_hash, gtm_file_to_process_type, gtm_file_to_process_bytes)
+                # The GTM deck is only read from, so one cached parse serves every copy step
+                gtm_prs = load_pptx(gtm_file_to_process_hash, gtm_file_to_process_bytes) if gtm_is_pptx else None
+                steps_to_build = st.session_state.structure[:len(new_prs.slides)]
+                gtm_selections = find_slides_by_ai(api_key, gtm_slides_data, [step["keyword"] for step in steps_to_build], "GTM Deck")
+                if batch_mode:
+                    step_ai_results = run_steps_ai_in_batch(api_key, steps_to_build, gtm_selections, gtm_is_pptx, all_template_slides_for_ai)
+                    if step_ai_results is None:
+                        st.info(f"Submitted OpenAI batch {st.session_state.pending_batch['id']}. The presentation is assembled once it completes.")
+                        st.button("Check batch status")
+                        st.stop()
+                else:
+                    # Each step's mapping call is an independent round-trip: issue them all at once, and apply each result
+                    # as soon as it and the ones before it are back, so slide edits overlap the remaining requests
+                    # Steps sharing a keyword get the same GTM slide, and so the same mapping request: send each one once
+                    step_keys = [(step["keyword"], needs_mapping(step, gtm_is_pptx)) for step in steps_to_build]
+                    step_pool = script_thread_pool(min(8, max(1, len(steps_to_build))))
+                    step_futures = {}
+                    for step, step_key in zip(steps_to_build, step_keys):
+                        if step_key not in step_futures:
+                            step_futures[step_key] = step_pool.submit(run_step_ai, api_key, step, gtm_selections[step["keyword"]], gtm_is_pptx, all_template_slides_for_ai)
+                    step_pool.shutdown(wait=False)
+                    step_ai_results = (step_futures[step_key].result() for step_key in step_keys)
 
+                for i, (step, step_ai) in enumerate(zip(steps_to_build, step_ai_results)):
                     current_dest_slide_index = i
                     dest_slide = new_prs.slides[current_dest_slide_index] 
                     keyword = step["keyword"]
@@ -384,9 +980,8 @@ if uploaded_template_files and uploaded_gtm_file and api_key and st.session_stat
                     log_entry = {"step": i + 1, "keyword": keyword, "action": action, "log": []}
                     
                     if action == "Copy from GTM (as is)":
-                        if gtm_file_to_process_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation': 
-                            gtm_prs = Presentation(io.BytesIO(gtm_file_to_process_bytes))
-                            result = find_slide_by_ai(api_key, gtm_file_to_process_bytes, gtm_file_to_process_type, keyword, "GTM Deck")
+                        if gtm_is_pptx: 
+                            result = step_ai["selection"]
                             log_entry["log"].append(f"**GTM Content Choice Justification (PPTX Copy):** {result['justification']}")
                             if result["slide"]:
                                 src_slide_object = gtm_prs.slides[result["index"]] 
@@ -396,15 +991,9 @@ if uploaded_template_files and uploaded_gtm_file and api_key and st.session_stat
                                 log_entry["log"].append("**Action:** No suitable slide found in GTM PPTX deck. Template slide was left as is.")
                         else: 
                             log_entry["log"].append(f"**Warning:** 'Copy from GTM (as is)' is selected but GTM deck is a PDF. This action cannot directly copy PPTX shapes from a PDF. Proceeding with 'Merge' logic for content extraction based on text and assumed visuals.")
-                            gtm_ai_selection_result = find_slide_by_ai(api_key, gtm_file_to_process_bytes, gtm_file_to_process_type, keyword, "GTM Deck (Content Source)")
+                            gtm_ai_selection_result = step_ai["selection"]
                             log_entry["log"].append(f"**GTM Content Source Justification (PDF Fallback Merge):** {gtm_ai_selection_result['justification']}")
-                            raw_gtm_content = {"title": "", "body": ""}
-                            if gtm_ai_selection_result["slide"]:
-                                full_text = gtm_ai_selection_result["slide"].get("text", "")
-                                lines = full_text.split('\n')
-                                raw_gtm_content["title"] = lines[0] if lines else ""
-                                raw_gtm_content["body"] = "\n".join(lines[1:]) if len(lines) > 1 else ""
-                            ai_mapping_result = analyze_and_map_content(api_key, raw_gtm_content, all_template_slides_for_ai, keyword)
+                            ai_mapping_result = step_ai["mapping"]
                             log_entry["log"].append(f"**AI Template Mapping Justification (PDF Fallback Merge):** {ai_mapping_result['justification']}")
                             selected_template_index = ai_mapping_result["best_template_index"]
                             processed_content = ai_mapping_result["processed_content"]
@@ -415,15 +1004,9 @@ if uploaded_template_files and uploaded_gtm_file and api_key and st.session_stat
                                 log_entry["log"].append("**Action:** AI could not determine a suitable template layout or process content for PDF. Template slide was left as is.")
 
                     elif action == "Merge: Template Layout + GTM Content":
-                        gtm_ai_selection_result = find_slide_by_ai(api_key, gtm_file_to_process_bytes, gtm_file_to_process_type, keyword, "GTM Deck (Content Source)")
+                        gtm_ai_selection_result = step_ai["selection"]
                         log_entry["log"].append(f"**GTM Content Source Justification:** {gtm_ai_selection_result['justification']}")
-                        raw_gtm_content = {"title": "", "body": ""}
-                        if gtm_ai_selection_result["slide"]:
-                            full_text = gtm_ai_selection_result["slide"].get("text", "")
-                            lines = full_text.split('\n')
-                            raw_gtm_content["title"] = lines[0] if lines else ""
-                            raw_gtm_content["body"] = "\n".join(lines[1:]) if len(lines) > 1 else ""
-                        ai_mapping_result = analyze_and_map_content(api_key, raw_gtm_content, all_template_slides_for_ai, keyword)
+                        ai_mapping_result = step_ai["mapping"]
                         log_entry["log"].append(f"**AI Template Mapping Justification:** {ai_mapping_result['justification']}")
                         selected_template_index = ai_mapping_result["best_template_index"]
                         processed_content = ai_mapping_result["processed_content"]
@@ -442,17 +1025,22 @@ if uploaded_template_files and uploaded_gtm_file and api_key and st.session_stat
                         for line in entry['log']: 
                             st.markdown(f"- {line}")
                 output_buffer = io.BytesIO()
-                new_prs.save(output_buffer)
-                output_buffer.seek(0)
-                st.success("✨ Your new regional presentation has been assembled!")
-                st.download_button(
-                    "Download Assembled PowerPoint", 
-                    data=output_buffer, 
-                    file_name="Dynamic_AI_Assembled_Deck.pptx",
-                    mime="application/vnd.openxmlformats-officedocument.presentationml.presentation"
-                )
+                save_presentation(new_prs, output_buffer)
+                # getvalue() hands over the buffer's bytes without a copy; dropping the BytesIO right away means
+                # only one copy of the deck is alive while Streamlit registers the download
+                st.session_state.assembled_deck = output_buffer.getvalue()
+                del output_buffer
             except Exception as e:
                 st.error(f"A critical error occurred: {e}")
                 st.exception(e)
+            finally:
+                # If applying the results stopped early (an error, or a rerun), the mapping requests still queued or in
+                # flight would keep running cached calls on the script's context while later widgets render; cancel
+                # the queued ones and let the running ones finish here instead
+                if step_pool is not None:
+                    step_pool.shutdown(cancel_futures=True)
 else:
     st.info("Please provide an API Key, upload your Template/GTM documents, and define the structure in the sidebar to begin.")
+
+if "assembled_deck" in st.session_state:
+    render_download()
@@ -1,26 +1,247 @@
 # new_conversion_service.py
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 import os
 import tempfile
 import base64
 import io
-from pptx import Presentation # For text extraction
+import mmap
+import posixpath
+import zipfile
+import queue
+import threading
+from concurrent.futures import Future
+from lxml import etree # For reading slide text straight from the XML
 import win32com.client # For controlling PowerPoint
 import pythoncom # For COM initialization
 
+# --- Hardened XML Parser ---
+# Uploaded decks are untrusted: never resolve entities or touch the network, and drop comments/processing
+# instructions and blank text so each slide parses into the smallest possible tree
+_xml_parser = etree.XMLParser(
+    remove_blank_text=True,
+    resolve_entities=False,
+    no_network=True,
+    huge_tree=False,
+    remove_comments=True,
+    remove_pis=True,
+)
+
 app = FastAPI()
 
+# --- Precompiled XPath Queries ---
+_NS = {
+    'p': 'http://schemas.openxmlformats.org/presentationml/2006/main',
+    'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
+}
+# Text bodies of the top-level shapes on a slide (the ones slide.shapes would wrap)
+_SHAPE_TXBODIES = etree.XPath('./p:cSld/p:spTree/p:sp/p:txBody', namespaces=_NS)
+_A_P = '{%s}p' % _NS['a']
+_A_T = '{%s}t' % _NS['a']
+_A_BR = '{%s}br' % _NS['a']
+_SLIDE_RIDS = etree.XPath(
+    './p:sldIdLst/p:sldId/@r:id',
+    namespaces={**_NS, 'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'},
+)
+_PKG_RELATIONSHIP = '{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'
+_OFFICE_DOCUMENT_RELTYPE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+
+
+def _shape_texts(slide_element) -> list[str]:
+    """
+    Returns the text of every text-bearing shape on a slide, without constructing
+    python-pptx Shape/TextFrame wrappers. Each text body is read in a single
+    C-level walk over its a:p and a:t elements instead of one XPath per paragraph.
+    """
+    shape_texts = []
+    for tx_body in _SHAPE_TXBODIES(slide_element):
+        paragraphs = []
+        for elem in tx_body.iter(_A_P, _A_T, _A_BR):
+            if elem.tag == _A_P:
+                paragraphs.append([])
+            elif elem.tag == _A_BR:
+                # A line break reads as a vertical tab, as in shape.text, so the words around it stay apart
+                paragraphs[-1].append("\v")
+            else:
+                paragraphs[-1].append(elem.text or "")
+        shape_texts.append("\n".join("".join(runs) for runs in paragraphs))
+    return shape_texts
+
+def _join_truncated(texts, limit: int) -> str:
+    """
+    Returns " ".join(texts)[:limit], but stops collecting texts once the limit is
+    reached, so a slide with a huge table never builds its full joined text.
+    """
+    parts = []
+    length = -1
+    for text in texts:
+        parts.append(text)
+        length += len(text) + 1
+        if length >= limit:
+            break
+    return " ".join(parts)[:limit]
+
+def _read_rels(zip_file, part_name: str) -> dict:
+    """
+    Returns {rId: (type, absolute member name)} for the relationships of `part_name`
+    ('' for the package itself).
+    """
+    part_dir, part_file = posixpath.split(part_name)
+    rels_xml = zip_file.read(posixpath.join(part_dir, '_rels', part_file + '.rels'))
+    rels = {}
+    for rel in etree.fromstring(rels_xml, _xml_parser).iter(_PKG_RELATIONSHIP):
+        target = rel.get('Target')
+        target = target[1:] if target.startswith('/') else posixpath.normpath(posixpath.join(part_dir, target))
+        rels[rel.get('Id')] = (rel.get('Type'), target)
+    return rels
+
+
+def _iter_slide_texts(pptx_bytes: bytes):
+    """
+    Yields the shape texts of each slide in presentation order, reading the slide
+    XML straight from the zip. Unlike Presentation(), this never loads the media
+    parts, and only one slide tree is alive at a time.
+    """
+    with zipfile.ZipFile(io.BytesIO(pptx_bytes)) as zip_file:
+        presentation_name = next(
+            target for reltype, target in _read_rels(zip_file, '').values()
+            if reltype == _OFFICE_DOCUMENT_RELTYPE
+        )
+        presentation_rels = _read_rels(zip_file, presentation_name)
+        presentation = etree.fromstring(zip_file.read(presentation_name), _xml_parser)
+        for rId in _SLIDE_RIDS(presentation):
+            with zip_file.open(presentation_rels[rId][1]) as slide_xml:
+                slide = etree.parse(slide_xml, _xml_parser).getroot()
+            yield _shape_texts(slide)
+            slide.clear()
+
+# --- PowerPoint Worker ---
+# Launching PowerPoint takes seconds, so one instance is started on first use and kept for the life of the
+# service. COM objects belong to the thread that created them, so a single worker thread owns PowerPoint and
+# runs the conversion jobs one after another.
+_powerpoint_jobs = queue.Queue()
+_powerpoint_thread = None
+_powerpoint_thread_lock = threading.Lock()
+
+def _ensure_powerpoint(powerpoint):
+    """
+    Returns a live PowerPoint application, reusing `powerpoint` unless it was
+    closed (by a user or a crash) since the last job.
+    """
+    if powerpoint is not None:
+        try:
+            powerpoint.Version
+            return powerpoint
+        except pythoncom.com_error:
+            pass
+    powerpoint = win32com.client.Dispatch("PowerPoint.Application")
+    powerpoint.Visible = 1 # Make it visible for debugging, can be set to 0
+    return powerpoint
+
+def _powerpoint_worker():
+    # Initialize the COM library once for this thread; every job runs in it
+    pythoncom.CoInitialize()
+    powerpoint = None
+    try:
+        while True:
+            item = _powerpoint_jobs.get()
+            if item is None:
+                break
+            job, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                powerpoint = _ensure_powerpoint(powerpoint)
+                future.set_result(job(powerpoint))
+            except Exception as e:
+                future.set_exception(e)
+    finally:
+        if powerpoint is not None:
+            powerpoint.Quit()
+        pythoncom.CoUninitialize()
+
+def _run_with_powerpoint(job) -> Future:
+    """
+    Queues `job(powerpoint)` on the PowerPoint worker thread, starting the
+    worker on first use, and returns a Future for its result.
+    """
+    global _powerpoint_thread
+    with _powerpoint_thread_lock:
+        if _powerpoint_thread is None:
+            _powerpoint_thread = threading.Thread(target=_powerpoint_worker, name="powerpoint", daemon=True)
+            _powerpoint_thread.start()
+    future = Future()
+    _powerpoint_jobs.put((job, future))
+    return future
+
+@app.on_event("startup")
+def _start_powerpoint():
+    # Launch PowerPoint in the background now, so the first request does not pay for its startup
+    _run_with_powerpoint(lambda powerpoint: None)
+
+@app.on_event("shutdown")
+def _stop_powerpoint():
+    if _powerpoint_thread is not None:
+        _powerpoint_jobs.put(None)
+        _powerpoint_thread.join()
+
 # --- New Helper Function using PowerPoint Automation ---
 
+# Slide images are only used as visual context for the model, which downsamples anything larger
+_THUMBNAIL_WIDTH = 1024
+# JPEG thumbnails of rendered slides are a fraction of the PNG size, which shrinks both the base64 work here
+# and the response; the model only looks at them at low detail
+_THUMBNAIL_FILTER = "JPG"
+_THUMBNAIL_TYPE = "image/jpeg"
+# Characters of slide text returned per slide
+_MAX_SLIDE_TEXT = 2000
+
+def _export_slides(powerpoint, pptx_path: str, pptx_bytes: bytes, image_dir: str) -> list[dict]:
+    """
+    Exports a thumbnail of every slide with the running PowerPoint instance and
+    pairs it with the slide's text. Runs on the PowerPoint worker thread.
+    """
+    results = []
+    # Open the presentation
+    presentation = powerpoint.Presentations.Open(pptx_path, WithWindow=False)
+    try:
+        # Scale every export to the same thumbnail width; the slide size is shared, so work out the height once
+        page_setup = presentation.PageSetup
+        thumbnail_height = round(_THUMBNAIL_WIDTH * page_setup.SlideHeight / page_setup.SlideWidth)
+        com_slides = presentation.Slides
+
+        # Iterate through each slide
+        for i, slide_text_content in enumerate(_iter_slide_texts(pptx_bytes)):
+            # 1. Export the slide as an image using PowerPoint
+            image_path = os.path.join(image_dir, f"slide_{i+1}.jpg")
+            com_slides[i].Export(image_path, _THUMBNAIL_FILTER, _THUMBNAIL_WIDTH, thumbnail_height)
+
+            # 2. Encode the exported image to Base64 straight from a read-only mapping of the file,
+            # without first reading it into a bytes copy
+            with open(image_path, "rb") as img_file, mmap.mmap(img_file.fileno(), 0, access=mmap.ACCESS_READ) as image_map:
+                image_data = base64.b64encode(image_map).decode('ascii')
+
+            # 3. Join the text read straight from the slide XML
+            text = _join_truncated(slide_text_content, _MAX_SLIDE_TEXT)
+
+            results.append({
+                "slide_index": i,
+                "text": text,
+                "image_data": image_data,
+                "image_type": _THUMBNAIL_TYPE
+            })
+    finally:
+        # Only the presentation is closed; PowerPoint itself stays up for the next request
+        presentation.Close()
+    return results
+
 def _convert_pptx_to_images_and_text_windows(pptx_bytes: bytes) -> list[dict]:
     """
     Converts a PPTX file to images and extracts text by automating the
     PowerPoint application on Windows.
     Requires PowerPoint to be installed.
     """
-    results = []
-    
     # Use a temporary directory to save the file and images
     with tempfile.TemporaryDirectory() as temp_dir:
         temp_pptx_path = os.path.join(temp_dir, "input.pptx")
@@ -29,58 +250,13 @@ def _convert_pptx_to_images_and_text_windows(pptx_bytes: bytes) -> list[dict]:
         with open(temp_pptx_path, "wb") as f:
             f.write(pptx_bytes)
 
-        powerpoint = None
-        presentation = None
         try:
-            # Initialize the COM library for this thread
-            pythoncom.CoInitialize()
-            
-            # Start the PowerPoint application
-            powerpoint = win32com.client.Dispatch("PowerPoint.Application")
-            powerpoint.Visible = 1 # Make it visible for debugging, can be set to 0
-            
-            # Open the presentation
-            presentation = powerpoint.Presentations.Open(temp_pptx_path, WithWindow=False)
-
-            # Use python-pptx to get the text content in parallel
-            prs_for_text = Presentation(io.BytesIO(pptx_bytes))
-
-            # Iterate through each slide
-            for i, slide in enumerate(prs_for_text.slides):
-                # 1. Export the slide as a PNG image using PowerPoint
-                image_path = os.path.join(temp_dir, f"slide_{i+1}.png")
-                presentation.Slides[i].Export(image_path, "PNG")
-
-                # 2. Read the exported image bytes and encode to Base64
-                with open(image_path, "rb") as img_file:
-                    image_data = base64.b64encode(img_file.read()).decode('utf-8')
-
-                # 3. Extract text using python-pptx
-                slide_text_content = []
-                for shape in slide.shapes:
-                    if shape.has_text_frame:
-                        slide_text_content.append(shape.text)
-                text = " ".join(slide_text_content)[:2000]
-
-                results.append({
-                    "slide_index": i,
-                    "text": text,
-                    "image_data": image_data
-                })
-
+            return _run_with_powerpoint(
+                lambda powerpoint: _export_slides(powerpoint, temp_pptx_path, pptx_bytes, temp_dir)
+            ).result()
         except Exception as e:
             # If anything goes wrong, raise an error
             raise HTTPException(status_code=500, detail=f"PowerPoint automation failed: {e}. Ensure PowerPoint is installed and not blocked by security settings.")
-        finally:
-            # 4. VERY IMPORTANT: Clean up the COM objects
-            if presentation:
-                presentation.Close()
-            if powerpoint:
-                powerpoint.Quit()
-            # Uninitialize the COM library
-            pythoncom.CoUninitialize()
-
-    return results
 
 
 @app.post("/convert_document")
@@ -93,8 +269,9 @@ async def convert_document_endpoint(file: UploadFile = File(...)):
     file_type = file.content_type
 
     if file_type == 'application/vnd.openxmlformats-officedocument.presentationml.presentation':
-        # Use the new Windows-specific conversion function
-        slides_data = _convert_pptx_to_images_and_text_windows(file_bytes)
+        # Use the new Windows-specific conversion function. It blocks until PowerPoint has exported every slide,
+        # so it runs in the threadpool and the event loop keeps accepting requests in the meantime.
+        slides_data = await run_in_threadpool(_convert_pptx_to_images_and_text_windows, file_bytes)
     else:
         raise HTTPException(status_code=400, detail=f"Unsupported file type: {file_type}. This version only supports PPTX files.")
     